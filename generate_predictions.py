@@ -1,18 +1,57 @@
 # --- generate_predictions.py (FINAL VERSION with Historical CSV Logging) ---
 
 import os
-import json
+import re
+import hashlib
+import orjson
+import diskcache
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+import pyarrow.csv as pa_csv
+import shutil
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
 import yfinance as yf
 from datetime import datetime, timezone
+from typing import Literal
+from pydantic import BaseModel, ValidationError
+from concurrent.futures import ThreadPoolExecutor
 import time
-import csv # Import the CSV library
+import random
+import threading
 
 # --- Configuration ---
 SYMBOLS = ['AAPL', 'GOOGL', 'TSLA', 'MSFT']
 LIVE_JSON_FILE = 'predictions.json' # File for the live dashboard
 HISTORY_CSV_FILE = 'history.csv'   # New file for historical data logging
+CACHE_DIR = '.cache'               # On-disk cache for prices, news and Gemini replies
+CACHE_TTL_SECONDS = 24 * 60 * 60   # Matches the daily refresh cadence
+NEWS_CACHE_TTL_SECONDS = 60 * 60   # Headlines move faster than daily bars
+PRICE_CACHE_TTL_SECONDS = 15 * 60  # The last bar is live while the market is open, so keep prices only briefly
+GEMINI_REQUESTS_PER_MINUTE = 15    # gemini-1.5-flash free-tier quota
+HISTORY_HEADERS = (
+    'date', 'symbol', 'actual_price', 'price_change', 
+    'price_change_percent', 'ai_sentiment_for_tomorrow', 
+    'predicted_low_for_tomorrow', 'predicted_high_for_tomorrow',
+    'yesterdays_predicted_range', 'accuracy_check_hit'
+)
+HISTORY_PARQUET_DIR = 'history.parquet'  # Columnar copy of the history log, partitioned by year/month
+HISTORY_ROW_SCHEMA = pa.schema([
+    ('date', pa.string()), ('symbol', pa.string()), ('actual_price', pa.float64()),
+    ('price_change', pa.float64()), ('price_change_percent', pa.float64()),
+    ('ai_sentiment_for_tomorrow', pa.string()),
+    ('predicted_low_for_tomorrow', pa.float64()), ('predicted_high_for_tomorrow', pa.float64()),
+    ('yesterdays_predicted_range', pa.string()), ('accuracy_check_hit', pa.bool_())
+])
+HISTORY_PARQUET_SCHEMA = HISTORY_ROW_SCHEMA.append(pa.field('year', pa.int32())).append(pa.field('month', pa.int32()))
+# Hive discovery alone reads year/month back as dictionary<int32>; passing this keeps them plain int32 like the schema.
+HISTORY_PARQUET_PARTITIONING = ds.partitioning(pa.schema([('year', pa.int32()), ('month', pa.int32())]), flavor='hive')
+CODE_FENCE_RE = re.compile(r'^```(?:json)?\s*|\s*```$')  # Markdown fences Gemini sometimes wraps its JSON in
+BLOCKED_FINISH_REASONS = ('SAFETY', 'RECITATION', 'BLOCKLIST', 'PROHIBITED_CONTENT')
+PROMPT_PRICE_COLUMNS = ['High', 'Low', 'Close', 'Volume']  # Open adds tokens without informing a next-day range
 
 # --- API Setup ---
 try:
@@ -24,150 +63,422 @@ except KeyError:
 
 GEMINI_API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash-latest:generateContent?key={GEMINI_API_KEY}"
 
+# One pooled session shared by all worker threads, so Gemini and NewsAPI connections stay warm.
+# Transient HTTP failures (rate limits, 5xx) are retried here, including POSTs to Gemini: a 429/503 waits
+# exactly as long as the server's Retry-After asks, anything else backs off exponentially with jitter.
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=8, pool_maxsize=8,
+    max_retries=Retry(total=3, backoff_factor=1, backoff_jitter=1.0, status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=frozenset({'GET', 'POST'}), respect_retry_after_header=True)
+))
+
+# --- Errors ---
+class CircuitOpenError(Exception):
+    """Raised instead of calling Gemini while its circuit breaker is open."""
+
+class GeminiBlockedError(ValueError):
+    """Raised when Gemini refuses a prompt on safety grounds; the same prompt will be refused again."""
+
+# --- Rate Limiting ---
+class TokenBucket:
+    """Thread-safe token bucket that only blocks once the request budget for the window is spent."""
+    def __init__(self, rate, per_seconds):
+        self.capacity = rate
+        self.tokens = float(rate)
+        self.fill_rate = rate / per_seconds
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.fill_rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                time.sleep((1 - self.tokens) / self.fill_rate)
+
+GEMINI_LIMITER = TokenBucket(GEMINI_REQUESTS_PER_MINUTE, 60)
+
+# --- Circuit Breaker ---
+class CircuitBreaker:
+    """Opens on the first upstream outage so later calls fail fast, letting a single probe through once the cooldown has passed."""
+    def __init__(self, cooldown=60):
+        self.cooldown = cooldown
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None: return
+            if time.monotonic() - self.opened_at < self.cooldown:
+                raise CircuitOpenError("gemini_unavailable")
+            # Half-open: this call probes the upstream; restarting the window keeps concurrent callers failing fast.
+            self.opened_at = time.monotonic()
+
+    def record_success(self):
+        with self.lock:
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.opened_at = time.monotonic()
+
+# A counted failure has already exhausted the adapter's own retries, so one is enough to stop the remaining calls.
+GEMINI_BREAKER = CircuitBreaker(cooldown=60)
+GEMINI_OUTAGE_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.RetryError)
+
+# Re-running the script on the same day reuses today's prices, news and Gemini replies instead of fetching them again.
+CACHE = diskcache.Cache(CACHE_DIR)
+
+# --- Response Schema ---
+class PredictionModel(BaseModel):
+    """One symbol's analysis as Gemini must return it."""
+    sentiment: Literal['Bullish', 'Bearish', 'Neutral']
+    reasoning: str
+    predicted_low: float
+    predicted_high: float
+
 # --- Helper Functions ---
-def get_stock_data_and_news(symbol):
-    """Fetches historical stock data and recent news."""
-    stock_data = yf.download(symbol, period="2mo", auto_adjust=True)
+def download_all_stock_data(run_date):
+    """Fetches two months of history for every symbol in one batched yfinance request, cached on disk briefly."""
+    cache_key = ('prices', tuple(SYMBOLS), run_date)
+    cached = CACHE.get(cache_key)
+    if cached is not None: return cached
+    all_stock_data = yf.download(SYMBOLS, period="2mo", auto_adjust=True, group_by='ticker', threads=True, progress=False)
+    # A ticker that failed comes back as all-NaN columns; caching that frame would pin the failure, so only cache complete ones.
+    try:
+        for symbol in SYMBOLS: get_stock_data(symbol, all_stock_data)
+    except (KeyError, ValueError):
+        return all_stock_data
+    CACHE.set(cache_key, all_stock_data, expire=PRICE_CACHE_TTL_SECONDS)
+    return all_stock_data
+
+def get_stock_data(symbol, all_stock_data):
+    """Slices a symbol's pre-fetched stock data, rejecting symbols without enough history."""
+    stock_data = all_stock_data[symbol].dropna(how='all')
     if stock_data.empty or len(stock_data) < 2:
         raise ValueError(f"yfinance returned insufficient data for {symbol}")
-    news_headlines = "No recent news found."
-    if NEWS_API_KEY:
+    return stock_data
+
+def fetch_news(symbol, run_date):
+    """Fetches recent headlines for a symbol, cached on disk for an hour."""
+    if not NEWS_API_KEY: return "No recent news found."
+    cache_key = ('news', symbol, run_date)
+    cached = CACHE.get(cache_key)
+    if cached is not None: return cached
+    try:
+        news_url = f"https://newsapi.org/v2/everything?q={symbol}&language=en&sortBy=publishedAt&pageSize=10&apiKey={NEWS_API_KEY}"
+        response = SESSION.get(news_url); response.raise_for_status()
+        news_headlines = "\n".join([f"- {a['title']}" for a in response.json().get('articles', [])])
+    except requests.RequestException as e: return f"Could not fetch news: {e}"
+    CACHE.set(cache_key, news_headlines, expire=NEWS_CACHE_TTL_SECONDS)
+    return news_headlines
+
+def call_gemini(prompt, label, run_date, parse_reply):
+    """Returns Gemini's parsed reply for a prompt, reusing today's cached reply for an identical prompt."""
+    cache_key = ('gemini', run_date, hashlib.blake2b(prompt.encode()).hexdigest())
+    cached = CACHE.get(cache_key)
+    if cached is not None: return cached
+    result = request_gemini(prompt, label, parse_reply)
+    CACHE.set(cache_key, result, expire=CACHE_TTL_SECONDS)
+    return result
+
+def request_gemini(prompt, label, parse_reply):
+    """Sends a prompt to Gemini and parses its JSON reply with parse_reply, retrying when the model returns unusable output."""
+    payload = {"contents": [{"parts": [{"text": prompt}]}]}
+    max_retries, backoff_base, backoff_cap = 3, 0.5, 8
+    for attempt in range(max_retries):
         try:
-            news_url = f"https://newsapi.org/v2/everything?q={symbol}&language=en&sortBy=publishedAt&pageSize=10&apiKey={NEWS_API_KEY}"
-            response = requests.get(news_url); response.raise_for_status()
-            news_headlines = "\n".join([f"- {a['title']}" for a in response.json().get('articles', [])])
-        except requests.RequestException as e: news_headlines = f"Could not fetch news: {e}"
-    return stock_data, news_headlines
-
-def get_ai_analysis(symbol, historical_data, news_headlines):
-    """Generates structured analysis, retrying on failure."""
+            GEMINI_BREAKER.before_call()
+            GEMINI_LIMITER.acquire()
+            try:
+                # Stream the body so an error status is raised before anything is downloaded.
+                with SESSION.post(GEMINI_API_URL, json=payload, timeout=45, stream=True) as response:
+                    response.raise_for_status()
+                    body = bytearray()
+                    for chunk in response.iter_content(chunk_size=16384): body.extend(chunk)
+            except GEMINI_OUTAGE_ERRORS:
+                GEMINI_BREAKER.record_failure()
+                raise
+            GEMINI_BREAKER.record_success()
+            json_response = orjson.loads(body)
+            candidates = json_response.get('candidates')
+            if not candidates:
+                prompt_feedback = json_response.get('promptFeedback') or {}
+                if prompt_feedback.get('blockReason'): raise GeminiBlockedError(f"API response blocked. Reason: {prompt_feedback['blockReason']}")
+                raise ValueError(f"API response empty. Reason: {prompt_feedback or 'Unknown'}")
+            if candidates[0].get('finishReason') in BLOCKED_FINISH_REASONS: raise GeminiBlockedError(f"API response blocked. Reason: {candidates[0]['finishReason']}")
+            text_content = candidates[0]['content']['parts'][0]['text']
+            clean_text = CODE_FENCE_RE.sub('', text_content.strip())
+            return parse_reply(clean_text)
+        except GeminiBlockedError:
+            # A safety block is deterministic for the same prompt; retrying only burns quota.
+            raise
+        except (orjson.JSONDecodeError, KeyError, IndexError, ValueError) as e:
+            print(f"Attempt {attempt + 1} for {label} failed: {e}")
+            # Exponential backoff with full jitter, so retries don't land in lockstep.
+            if attempt < max_retries - 1: time.sleep(random.uniform(0, min(backoff_cap, backoff_base * 2 ** attempt)))
+            else: raise
+
+def parse_prediction(text):
+    """Parses and validates a single-symbol reply in one pass; a ValidationError is retried like malformed JSON."""
+    return PredictionModel.model_validate_json(text).model_dump()
+
+def parse_batch_reply(text):
+    """Parses a batch reply, rejecting anything but an object keyed by symbol so it is retried and never cached."""
+    analyses = orjson.loads(text)
+    if not isinstance(analyses, dict): raise ValueError("Batch response is not a JSON object keyed by symbol")
+    return analyses
+
+def validate_prediction(prediction):
+    """Returns a batch entry normalized by PredictionModel, or None if it breaks the schema."""
+    try:
+        return PredictionModel.model_validate(prediction).model_dump()
+    except ValidationError:
+        return None
+
+def format_price_history(historical_data):
+    """Renders the last 30 sessions as compact CSV for the prompt (far fewer tokens than to_string()), plus the 20-day SMA."""
+    close = historical_data['Close'].to_numpy()
+    sma_20 = f"{close[-20:].mean():.2f}" if len(close) >= 20 else "N/A"
+    return f"{historical_data.tail(30)[PROMPT_PRICE_COLUMNS].to_csv(float_format='%.2f')}20-day SMA: {sma_20}"
+
+def get_ai_analysis(symbol, historical_data, news_headlines, run_date):
+    """Generates structured analysis for a single symbol."""
     prompt = f"""
     Analyze the financial data for **{symbol}**. Respond with a single, clean JSON object with keys: "sentiment", "reasoning", "predicted_low", "predicted_high".
     - "sentiment": Must be "Bullish", "Bearish", or "Neutral".
     - Do not include any text, markdown, or explanations outside of the JSON object.
-    Historical Data: {historical_data.tail(30).to_string()}
+    Historical Data: {format_price_history(historical_data)}
     Recent News: {news_headlines}
     """
-    payload = {"contents": [{"parts": [{"text": prompt}]}]}
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            response = requests.post(GEMINI_API_URL, json=payload, timeout=45)
-            response.raise_for_status()
-            if not response.text: raise ValueError("Received empty response from API")
-            json_response = response.json()
-            candidates = json_response.get('candidates')
-            if not candidates: raise ValueError(f"API response blocked or empty. Reason: {json_response.get('promptFeedback', 'Unknown')}")
-            text_content = candidates[0]['content']['parts'][0]['text']
-            clean_text = text_content.strip().replace('```json', '').replace('```', '')
-            return json.loads(clean_text)
-        except (requests.RequestException, json.JSONDecodeError, KeyError, IndexError, ValueError) as e:
-            print(f"Attempt {attempt + 1} for {symbol} failed: {e}")
-            if attempt < max_retries - 1: time.sleep(2) 
-            else: raise
+    return call_gemini(prompt, symbol, run_date, parse_prediction)
+
+def get_batch_ai_analysis(market_inputs, run_date):
+    """Generates structured analysis for every symbol in one Gemini call; returns only well-formed entries."""
+    sections = "\n".join(
+        f"""
+    ## {symbol}
+    Historical Data: {format_price_history(historical_data)}
+    Recent News: {news_headlines}
+    """ for symbol, (historical_data, news_headlines) in market_inputs.items()
+    )
+    prompt = f"""
+    Analyze the financial data for each of these symbols: {', '.join(market_inputs)}. Respond with a single, clean JSON object keyed by symbol, where each value is an object with keys: "sentiment", "reasoning", "predicted_low", "predicted_high".
+    - "sentiment": Must be "Bullish", "Bearish", or "Neutral".
+    - Do not include any text, markdown, or explanations outside of the JSON object.
+    {sections}
+    """
+    analyses = call_gemini(prompt, "batch request", run_date, parse_batch_reply)
+    validated = {symbol: validate_prediction(analyses.get(symbol)) for symbol in market_inputs}
+    return {symbol: prediction for symbol, prediction in validated.items() if prediction is not None}
+
+def analyze_all(market_inputs, run_date):
+    """Analyzes all symbols with one batched call, falling back to per-symbol calls for anything it missed."""
+    try:
+        analyses = get_batch_ai_analysis(market_inputs, run_date)
+    except Exception as e:
+        print(f"Batch analysis failed, falling back to per-symbol calls: {e}")
+        analyses = {}
+    # Fallback calls are independent network round-trips, so overlap them; the shared limiter keeps them under quota.
+    missing = [symbol for symbol in market_inputs if symbol not in analyses]
+    if missing:
+        with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+            futures = {symbol: executor.submit(get_ai_analysis, symbol, *market_inputs[symbol], run_date) for symbol in missing}
+        for symbol, future in futures.items():
+            try:
+                analyses[symbol] = future.result()
+            except Exception as e:
+                analyses[symbol] = e
+    return analyses
 
 # --- NEW: Function to log data to CSV ---
-def log_to_history_csv(log_data):
+def format_csv_row(values):
+    """Joins one row of plain values (numbers, symbols, dates, booleans) into a CSV line; None becomes an empty field."""
+    return ','.join('' if value is None else str(value) for value in values) + '\r\n'
+
+def open_history_csv():
+    """Opens the history CSV for appending once per run, writing the header if the file is new."""
+    file_exists = os.path.isfile(HISTORY_CSV_FILE)
+    csvfile = open(HISTORY_CSV_FILE, 'a', newline='', encoding='utf-8', buffering=1 << 16)
+    if not file_exists:
+        csvfile.write(format_csv_row(HISTORY_HEADERS))
+    return csvfile
+
+def log_to_history_csv(csvfile, log_data):
     """Appends a new row of data to the history CSV file."""
-    headers = [
-        'date', 'symbol', 'actual_price', 'price_change', 
-        'price_change_percent', 'ai_sentiment_for_tomorrow', 
-        'predicted_low_for_tomorrow', 'predicted_high_for_tomorrow',
-        'yesterdays_predicted_range', 'accuracy_check_hit'
-    ]
+    csvfile.write(format_csv_row(log_data[header] for header in HISTORY_HEADERS))
+
+def write_history_parquet(table, basename, root_path=HISTORY_PARQUET_DIR):
+    """Adds the year/month partition columns to a table of history rows and writes it into the Parquet dataset."""
+    dates = table['date'].to_pylist()
+    table = table.append_column('year', pa.array([int(date[:4]) for date in dates], pa.int32()))
+    table = table.append_column('month', pa.array([int(date[5:7]) for date in dates], pa.int32()))
+    pq.write_to_dataset(table, root_path=root_path, partition_cols=['year', 'month'],
+                        basename_template=f"{basename}-{{i}}.parquet")
+
+def log_to_history_parquet(log_records, run_started_at):
+    """Appends this run's history rows to the Parquet dataset as new files, so re-runs add rows just like the CSV."""
+    if not log_records: return
+    columns = {header: [record[header] for record in log_records] for header in HISTORY_HEADERS}
+    table = pa.Table.from_pydict(columns, schema=HISTORY_ROW_SCHEMA)
+    write_history_parquet(table, run_started_at.strftime('%Y-%m-%dT%H%M%S%f'))
+
+def backfill_history_parquet():
+    """Imports the existing history CSV once, when the Parquet dataset does not exist yet."""
+    if os.path.isdir(HISTORY_PARQUET_DIR) or not os.path.isfile(HISTORY_CSV_FILE): return
+    table = pa_csv.read_csv(HISTORY_CSV_FILE, convert_options=pa_csv.ConvertOptions(column_types=HISTORY_ROW_SCHEMA))
+    if not table.num_rows: return
+    # Build the dataset aside and swap it in, so a failed import can't leave a partial dataset that blocks the next attempt.
+    tmp_parquet_dir = HISTORY_PARQUET_DIR + '.tmp'
+    shutil.rmtree(tmp_parquet_dir, ignore_errors=True)
+    write_history_parquet(table, 'history-csv-import', root_path=tmp_parquet_dir)
+    os.replace(tmp_parquet_dir, HISTORY_PARQUET_DIR)
+
+def read_history_parquet():
+    """Reads the whole Parquet history back with exactly the declared schema."""
+    return pq.read_table(HISTORY_PARQUET_DIR, schema=HISTORY_PARQUET_SCHEMA, partitioning=HISTORY_PARQUET_PARTITIONING)
+
+# --- Per-Symbol Records ---
+def build_records(symbol, stock_data, ai_prediction_for_tomorrow, previous_predictions, run_date):
+    """Builds the live and history records for one symbol; an empty analysis yields a price-only record."""
+    close_prices = stock_data['Close'].to_numpy()
+    current_price = float(close_prices[-1])
+    previous_close = float(close_prices[-2])
     
-    file_exists = os.path.isfile(HISTORY_CSV_FILE)
+    price_change = current_price - previous_close
+    price_change_percent = (price_change / previous_close) * 100
+    
+    # The model answers with separate low/high keys; the dashboard and tomorrow's accuracy check read a [low, high] pair.
+    predicted_low = ai_prediction_for_tomorrow.get('predicted_low')
+    predicted_high = ai_prediction_for_tomorrow.get('predicted_high')
+    predicted_range = [predicted_low, predicted_high] if predicted_low is not None and predicted_high is not None else None
     
-    with open(HISTORY_CSV_FILE, 'a', newline='', encoding='utf-8') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=headers)
-        
-        if not file_exists:
-            writer.writeheader()
-        
-        writer.writerow(log_data)
+    accuracy_check_hit = None
+    yesterdays_predicted_range_str = "N/A"
+    if symbol in previous_predictions:
+        yesterdays_pred = previous_predictions[symbol]
+        if 'predicted_range' in yesterdays_pred and yesterdays_pred['predicted_range'] and len(yesterdays_pred['predicted_range']) == 2:
+            pred_low = yesterdays_pred['predicted_range'][0]
+            pred_high = yesterdays_pred['predicted_range'][1]
+            if pred_low is not None and pred_high is not None:
+                accuracy_check_hit = pred_low <= current_price <= pred_high
+                yesterdays_predicted_range_str = f"${pred_low:.2f} - ${pred_high:.2f}"
+    
+    # 1. Prepare data for the LIVE JSON file
+    live_record = {
+        'symbol': symbol,
+        'current_price': round(current_price, 2),
+        'price_change': round(price_change, 2),
+        'price_change_percent': round(price_change_percent, 2),
+        'sentiment': ai_prediction_for_tomorrow.get('sentiment'),
+        'reasoning': ai_prediction_for_tomorrow.get('reasoning'),
+        'predicted_range': predicted_range,
+        'accuracy_check': {
+            "yesterdays_predicted_range": yesterdays_predicted_range_str,
+            "todays_actual_price": f"${current_price:.2f}",
+            "hit": accuracy_check_hit
+        } if accuracy_check_hit is not None else None
+    }
+
+    # 2. Prepare data for the HISTORY CSV file
+    historical_log_record = {
+        'date': run_date,
+        'symbol': symbol,
+        'actual_price': round(current_price, 4),
+        'price_change': round(price_change, 4),
+        'price_change_percent': round(price_change_percent, 4),
+        'ai_sentiment_for_tomorrow': ai_prediction_for_tomorrow.get('sentiment'),
+        'predicted_low_for_tomorrow': (predicted_range or [None, None])[0],
+        'predicted_high_for_tomorrow': (predicted_range or [None, None])[1],
+        'yesterdays_predicted_range': yesterdays_predicted_range_str,
+        'accuracy_check_hit': accuracy_check_hit
+    }
+
+    return live_record, historical_log_record
 
 # --- Main Execution Logic (UPGRADED) ---
-def main():
-    previous_predictions = {}
+def load_previous_predictions():
+    """Loads yesterday's successful predictions from the live JSON file, keyed by symbol."""
     try:
-        with open(LIVE_JSON_FILE, 'r') as f:
-            previous_data = json.load(f)
-            for item in previous_data.get('predictions', []):
-                if 'symbol' in item and 'error' not in item:
-                    previous_predictions[item['symbol']] = item
-    except (FileNotFoundError, json.JSONDecodeError):
+        with open(LIVE_JSON_FILE, 'rb') as f:
+            raw = f.read()
+        return {item['symbol']: item for item in orjson.loads(raw).get('predictions', []) if 'symbol' in item and 'error' not in item}
+    except (FileNotFoundError, orjson.JSONDecodeError):
         print("Previous prediction file not found. Starting fresh.")
+        return {}
 
-    todays_data_for_json = {'last_updated': datetime.now(timezone.utc).isoformat(), 'predictions': []}
+def main():
+    previous_predictions = load_previous_predictions()
 
-    for symbol in SYMBOLS:
-        print(f"Processing {symbol}...")
-        try:
-            if SYMBOLS.index(symbol) > 0:
-                print("Waiting 5 seconds to respect API rate limits...")
-                time.sleep(5)
-
-            stock_data, news = get_stock_data_and_news(symbol)
-            current_price = float(stock_data['Close'].iloc[-1])
-            previous_close = float(stock_data['Close'].iloc[-2])
-            
-            ai_prediction_for_tomorrow = get_ai_analysis(symbol, stock_data, news)
-            
-            price_change = current_price - previous_close
-            price_change_percent = (price_change / previous_close) * 100
-            
-            accuracy_check_hit = None
-            yesterdays_predicted_range_str = "N/A"
-            if symbol in previous_predictions:
-                yesterdays_pred = previous_predictions[symbol]
-                if 'predicted_range' in yesterdays_pred and yesterdays_pred['predicted_range'] and len(yesterdays_pred['predicted_range']) == 2:
-                    pred_low = yesterdays_pred['predicted_range'][0]
-                    pred_high = yesterdays_pred['predicted_range'][1]
-                    if pred_low is not None and pred_high is not None:
-                        accuracy_check_hit = pred_low <= current_price <= pred_high
-                        yesterdays_predicted_range_str = f"${pred_low:.2f} - ${pred_high:.2f}"
-            
-            # 1. Prepare data for the LIVE JSON file
-            live_record = {
-                'symbol': symbol,
-                'current_price': round(current_price, 2),
-                'price_change': round(price_change, 2),
-                'price_change_percent': round(price_change_percent, 2),
-                'sentiment': ai_prediction_for_tomorrow.get('sentiment'),
-                'reasoning': ai_prediction_for_tomorrow.get('reasoning'),
-                'predicted_range': ai_prediction_for_tomorrow.get('predicted_range'),
-                'accuracy_check': {
-                    "yesterdays_predicted_range": yesterdays_predicted_range_str,
-                    "todays_actual_price": f"${current_price:.2f}",
-                    "hit": accuracy_check_hit
-                } if accuracy_check_hit is not None else None
-            }
-            todays_data_for_json['predictions'].append(live_record)
-
-            # 2. Prepare data for the HISTORY CSV file
-            historical_log_record = {
-                'date': datetime.now(timezone.utc).strftime('%Y-%m-%d'),
-                'symbol': symbol,
-                'actual_price': round(current_price, 4),
-                'price_change': round(price_change, 4),
-                'price_change_percent': round(price_change_percent, 4),
-                'ai_sentiment_for_tomorrow': ai_prediction_for_tomorrow.get('sentiment'),
-                'predicted_low_for_tomorrow': (ai_prediction_for_tomorrow.get('predicted_range') or [None, None])[0],
-                'predicted_high_for_tomorrow': (ai_prediction_for_tomorrow.get('predicted_range') or [None, None])[1],
-                'yesterdays_predicted_range': yesterdays_predicted_range_str,
-                'accuracy_check_hit': accuracy_check_hit
-            }
-            log_to_history_csv(historical_log_record)
-
-            print(f"Successfully processed and logged {symbol}.")
+    # Every record and cache key from this run shares one timestamp and date.
+    run_started_at = datetime.now(timezone.utc)
+    run_date = run_started_at.strftime('%Y-%m-%d')
+    todays_data_for_json = {'last_updated': run_started_at.isoformat(timespec='seconds'), 'predictions': []}
 
+    # The Yahoo batch download and the NewsAPI fetches are independent network I/O, so overlap all of them.
+    with ThreadPoolExecutor(max_workers=len(SYMBOLS) + 1) as executor:
+        stock_future = executor.submit(download_all_stock_data, run_date)
+        news_futures = {symbol: executor.submit(fetch_news, symbol, run_date) for symbol in SYMBOLS}
+    market_inputs, failures = {}, {}
+    try:
+        all_stock_data = stock_future.result()
+    except Exception as e:
+        # A failed Yahoo download takes out every symbol, but the run still writes its error records.
+        failures = {symbol: e for symbol in SYMBOLS}
+    for symbol, news_future in news_futures.items():
+        if symbol in failures: continue
+        try:
+            market_inputs[symbol] = (get_stock_data(symbol, all_stock_data), news_future.result())
         except Exception as e:
-            print(f"CRITICAL ERROR processing {symbol}: {e}")
-            todays_data_for_json['predictions'].append({'symbol': symbol, 'error': str(e)})
+            failures[symbol] = e
+
+    # One Gemini call covers every symbol that has data.
+    analyses = analyze_all(market_inputs, run_date) if market_inputs else {}
+
+    # Seed the Parquet dataset from the CSV before this run appends to either.
+    try:
+        backfill_history_parquet()
+    except (pa.ArrowException, OSError) as e:
+        print(f"WARNING: Could not import {HISTORY_CSV_FILE} into {HISTORY_PARQUET_DIR}: {e}")
+
+    historical_log_records = []
+    with open_history_csv() as csvfile:
+        for symbol in SYMBOLS:
+            try:
+                if symbol in failures: raise failures[symbol]
+                # A failed analysis still records today's price move and yesterday's accuracy check.
+                analysis = analyses[symbol]
+                analysis_failed = isinstance(analysis, Exception)
+                live_record, historical_log_record = build_records(symbol, market_inputs[symbol][0], {} if analysis_failed else analysis, previous_predictions, run_date)
+                if analysis_failed:
+                    print(f"AI analysis failed for {symbol}, logging prices only: {analysis}")
+                    live_record['analysis_error'] = str(analysis)
+                todays_data_for_json['predictions'].append(live_record)
+                log_to_history_csv(csvfile, historical_log_record)
+                historical_log_records.append(historical_log_record)
+                print(f"Successfully processed and logged {symbol}.")
+            except Exception as e:
+                print(f"CRITICAL ERROR processing {symbol}: {e}")
+                todays_data_for_json['predictions'].append({'symbol': symbol, 'error': str(e)})
 
-    with open(LIVE_JSON_FILE, 'w') as f:
-        json.dump(todays_data_for_json, f, indent=4)
-    print(f"\nProcess complete. Updated {LIVE_JSON_FILE} and appended to {HISTORY_CSV_FILE}")
+    # Write to a temp file and swap it in, so a crash mid-write never leaves a truncated predictions file behind.
+    tmp_json_file = LIVE_JSON_FILE + '.tmp'
+    with open(tmp_json_file, 'wb') as f:
+        f.write(orjson.dumps(todays_data_for_json))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_json_file, LIVE_JSON_FILE)
+
+    try:
+        log_to_history_parquet(historical_log_records, run_started_at)
+    except (pa.ArrowException, OSError) as e:
+        print(f"WARNING: Could not write {HISTORY_PARQUET_DIR}: {e}")
+    print(f"\nProcess complete. Updated {LIVE_JSON_FILE} and appended to {HISTORY_CSV_FILE} and {HISTORY_PARQUET_DIR}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file